@@ -79,78 +79,41 @@ def create_fixed_backend():
 🔧 Creating fixed backend version...")
     
     fixed_code = '''
-async def extract_table_from_image(image_bytes: bytes, filename: str) -> Dict[str, Any]:
+async def extract_table_from_image(image_base64: str, filename: str) -> Dict[str, Any]:
     """Extract table data from image using AI with enhanced error handling"""
-    try:
-        # Detailed API key validation
-        api_key = os.environ.get('EMERGENT_LLM_KEY')
-        if not api_key:
-            logging.error("EMERGENT_LLM_KEY not found in environment variables")
-            return {
-                "success": False,
-                "message": "API key not configured. Check backend/.env file has EMERGENT_LLM_KEY=sk-emergent-04a78B4D1485026CdF",
-                "table_data": None
-            }
-        
-        if not api_key.startswith('sk-emergent-'):
-            logging.error(f"Invalid API key format: {api_key[:10]}...")
-            return {
-                "success": False,
-                "message": "Invalid API key format. Should start with 'sk-emergent-'",
-                "table_data": None
-            }
-        
-        logging.info(f"Processing image with API key: {api_key[:20]}...")
-        
-        # Convert image to base64
-        image_base64 = image_to_base64(image_bytes)
-        logging.info(f"Image converted to base64, size: {len(image_base64)} characters")
-        
-        # Import and validate emergentintegrations
-        try:
-            from emergentintegrations.llm.chat import LlmChat, UserMessage, ImageContent
-        except ImportError as e:
-            logging.error(f"EmergentIntegrations import failed: {e}")
-            return {
-                "success": False,
-                "message": "EmergentIntegrations library not properly installed. Run: pip install emergentintegrations --extra-index-url https://d33sy5i8bnduwe.cloudfront.net/simple/",
-                "table_data": None
-            }
-        
-        # Initialize LLM chat with detailed error handling
-        try:
-            chat = LlmChat(
-                api_key=api_key,
-                session_id=f"table_extraction_{uuid.uuid4()}",
-                system_message="You are an expert at analyzing handwritten tables and extracting structured data."
-            )
-            
-            # Configure model
-            chat = chat.with_model("openai", "gpt-4o")
-            logging.info("LlmChat initialized successfully")
-            
-        except Exception as e:
-            logging.error(f"Failed to initialize LlmChat: {e}")
-            return {
-                "success": False,
-                "message": f"Failed to initialize AI chat: {str(e)}",
-                "table_data": None
-            }
-        
-        # Create image content
-        try:
-            image_content = ImageContent(image_base64=image_base64)
-            logging.info("Image content created successfully")
-        except Exception as e:
-            logging.error(f"Failed to create image content: {e}")
-            return {
-                "success": False,
-                "message": f"Failed to process image: {str(e)}",
-                "table_data": None
-            }
-        
-        # Create extraction prompt
-        prompt = """Analyze this handwritten table image and extract all data into structured format.
+    # API key state is computed once at import (KeyState.OK / MISSING / BAD_FORMAT)
+    api_key = _EMERGENT_KEY
+    if _EMERGENT_KEY_STATE is KeyState.MISSING:
+        _err.error("llm_key", "EMERGENT_LLM_KEY not found in environment variables")
+        return {
+            "success": False,
+            "message": "API key not configured. Check backend/.env file has EMERGENT_LLM_KEY=sk-emergent-04a78B4D1485026CdF",
+            "table_data": None
+        }
+    
+    if _EMERGENT_KEY_STATE is KeyState.BAD_FORMAT:
+        _err.error("llm_key", f"Invalid API key format: {api_key[:10]}...")
+        return {
+            "success": False,
+            "message": "Invalid API key format. Should start with 'sk-emergent-'",
+            "table_data": None
+        }
+    
+    logging.info(f"Processing image with API key: {api_key[:20]}...")
+    
+    logging.info(f"Image received as base64, size: {len(image_base64)} characters")
+    
+    # EmergentIntegrations is imported once and cached by _load_emergent()
+    if not _load_emergent():
+        _err.error("llm_import", "EmergentIntegrations import failed")
+        return {
+            "success": False,
+            "message": "EmergentIntegrations library not properly installed. Run: pip install emergentintegrations --extra-index-url https://d33sy5i8bnduwe.cloudfront.net/simple/",
+            "table_data": None
+        }
+    
+    # Create extraction prompt
+    prompt = """Analyze this handwritten table image and extract all data into structured format.
 
 Requirements:
 1. First row = column headers/categories
@@ -168,59 +131,53 @@ Return ONLY valid JSON array:
 
 No explanations, just JSON array."""
 
-        # Send message with comprehensive error handling
-        try:
-            user_message = UserMessage(text=prompt, file_contents=[image_content])
-            logging.info("Sending message to AI...")
-            
-            response = await chat.send_message(user_message)
-            logging.info(f"Received response: {response[:100]}...")
-            
-        except Exception as e:
-            logging.error(f"Failed to send message to AI: {e}")
-            return {
-                "success": False,
-                "message": f"AI processing failed: {str(e)}. Check your internet connection and API key.",
-                "table_data": None
-            }
+    # Only the LLM library calls are guarded; the library raises its own error types
+    try:
+        chat = LlmChat(
+            api_key=api_key,
+            session_id=f"{_SESSION_PREFIX}_{next(_SESSION_COUNTER)}",
+            system_message="You are an expert at analyzing handwritten tables and extracting structured data."
+        ).with_model("openai", "gpt-4o")
         
-        # Parse the JSON response
-        try:
-            # Clean the response
-            response_text = response.strip()
-            if response_text.startswith('```json'):
-                response_text = response_text.replace('```json', '').replace('```', '')
-            elif response_text.startswith('```'):
-                response_text = response_text.replace('```', '')
-            
-            table_data = json.loads(response_text.strip())
-            
-            if not isinstance(table_data, list) or not table_data:
-                raise ValueError("Invalid table data format")
-            
-            logging.info(f"Successfully extracted {len(table_data)} rows with {len(table_data[0]) if table_data else 0} columns")
-                
-            return {
-                "success": True,
-                "table_data": table_data,
-                "message": f"Table extracted successfully: {len(table_data)} rows, {len(table_data[0]) if table_data else 0} columns"
-            }
-            
-        except json.JSONDecodeError as e:
-            logging.error(f"JSON parsing error: {e}, Response: {response}")
-            return {
-                "success": False,
-                "message": f"Failed to parse AI response. Raw response: {response[:200]}...",
-                "table_data": None
-            }
-            
+        image_content = ImageContent(image_base64=image_base64)
+        user_message = UserMessage(text=prompt, file_contents=[image_content])
+        logging.info("Sending message to AI...")
+        
+        response = await chat.send_message(user_message)
     except Exception as e:
-        logging.error(f"Unexpected error in extract_table_from_image: {e}")
+        _err.error("llm_send", str(e))
+        return {
+            "success": False,
+            "message": f"AI processing failed: {str(e)}. Check your internet connection and API key.",
+            "table_data": None
+        }
+    logging.info(f"Received response: {response[:100]}...")
+    
+    try:
+        table_data = orjson.loads(strip_code_fences(response))
+    except orjson.JSONDecodeError as e:
+        _err.error("ocr_parse", f"{e}, Response: {response[:200]}")
         return {
             "success": False,
-            "message": f"Unexpected error: {str(e)}",
+            "message": f"Failed to parse AI response. Raw response: {response[:200]}...",
             "table_data": None
         }
+    
+    if not isinstance(table_data, list) or not table_data or not isinstance(table_data[0], list):
+        _err.error("ocr_format", "AI response is not a list of rows")
+        return {
+            "success": False,
+            "message": "Invalid table data format",
+            "table_data": None
+        }
+    
+    logging.info(f"Successfully extracted {len(table_data)} rows with {len(table_data[0])} columns")
+    
+    return {
+        "success": True,
+        "table_data": table_data,
+        "message": f"Table extracted successfully: {len(table_data)} rows, {len(table_data[0])} columns"
+    }
 '''
     
     print("✅ Fixed backend code generated")
@@ -228,7 +185,7 @@ No explanations, just JSON array."""
     print("  - Enhanced API key validation")
     print("  - Better error messages")
     print("  - Detailed logging")
-    print("  - Step-by-step error handling")
+    print("  - Error handling scoped to the AI call and JSON parse")
     
     return fixed_code
 
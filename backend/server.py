@@ -1,44 +1,150 @@
-from fastapi import FastAPI, APIRouter, File, UploadFile, HTTPException
-from fastapi.responses import StreamingResponse
+from fastapi import FastAPI, APIRouter, File, UploadFile, HTTPException, BackgroundTasks
+from fastapi.responses import ORJSONResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
 from dotenv import load_dotenv
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo.errors import PyMongoError
 import os
 import logging
 import io
 import base64
 import uuid
-import json
+import orjson
 from pathlib import Path
+from collections import defaultdict
 from pydantic import BaseModel, Field
 from typing import List, Optional, Dict, Any
 from datetime import datetime
-from openpyxl import Workbook
-from openpyxl.styles import Font, Border, Side, PatternFill, Alignment
-
-# Try EmergentIntegrations
-try:
-    from emergentintegrations.llm.chat import LlmChat, UserMessage, ImageContent
-    EMERGENT_AVAILABLE = True
-except ImportError:
-    EMERGENT_AVAILABLE = False
-    print("⚠️  EmergentIntegrations not found. Install with:")
-    print("pip install emergentintegrations --extra-index-url https://d33sy5i8bnduwe.cloudfront.net/simple/")
+import enum
+import importlib.util
+import itertools
+import threading
+
+# EmergentIntegrations is heavy; import it lazily on first upload (see _load_emergent)
+_EMERGENT_AVAILABLE: Optional[bool] = None
+
+def _load_emergent() -> bool:
+    """Import EmergentIntegrations once and cache whether it is available"""
+    global _EMERGENT_AVAILABLE, LlmChat, UserMessage, ImageContent
+    if _EMERGENT_AVAILABLE is None:
+        try:
+            from emergentintegrations.llm.chat import LlmChat, UserMessage, ImageContent
+            _EMERGENT_AVAILABLE = True
+        except ImportError:
+            _EMERGENT_AVAILABLE = False
+            print("⚠️  EmergentIntegrations not found. Install with:")
+            print("pip install emergentintegrations --extra-index-url https://d33sy5i8bnduwe.cloudfront.net/simple/")
+    return _EMERGENT_AVAILABLE
+
+# openpyxl styles are invariant, so build them once on first Excel export
+_EXCEL_STYLES_LOCK = threading.Lock()
+_HEADER_FONT = _HEADER_FILL = _THIN = _CENTER = _BORDER = None
+
+def _load_excel_styles() -> None:
+    global _HEADER_FONT, _HEADER_FILL, _THIN, _CENTER, _BORDER
+    if _BORDER is not None:
+        return
+    with _EXCEL_STYLES_LOCK:
+        if _BORDER is None:
+            from openpyxl.styles import Font, Border, Side, PatternFill, Alignment
+            _HEADER_FONT = Font(bold=True, color="FFFFFF")
+            _HEADER_FILL = PatternFill(start_color="366092", end_color="366092", fill_type="solid")
+            _THIN = Side(style='thin')
+            _CENTER = Alignment(horizontal='center', vertical='center')
+            _BORDER = Border(left=_THIN, right=_THIN, top=_THIN, bottom=_THIN)
 
 # Load environment variables
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
+# Cached environment (read once at import, see refresh_env)
+class KeyState(enum.Enum):
+    OK = "ok"
+    MISSING = "missing"
+    BAD_FORMAT = "bad_format"
+
+def _key_state(key: Optional[str]) -> KeyState:
+    if not key:
+        return KeyState.MISSING
+    if not key.startswith('sk-emergent-'):
+        return KeyState.BAD_FORMAT
+    return KeyState.OK
+
+_EMERGENT_KEY = os.environ.get('EMERGENT_LLM_KEY')
+_EMERGENT_KEY_STATE = _key_state(_EMERGENT_KEY)
+
+_KEY_STATE_MESSAGES = {
+    KeyState.MISSING: "API key not configured. Set EMERGENT_LLM_KEY in backend/.env",
+    KeyState.BAD_FORMAT: "Invalid API key format. Should start with 'sk-emergent-'",
+}
+
+def refresh_env() -> None:
+    """Re-read cached environment values (useful in tests)"""
+    global _EMERGENT_KEY, _EMERGENT_KEY_STATE
+    _EMERGENT_KEY = os.environ.get('EMERGENT_LLM_KEY')
+    _EMERGENT_KEY_STATE = _key_state(_EMERGENT_KEY)
+
 # MongoDB connection
 mongo_url = os.environ.get('MONGO_URL', 'mongodb://localhost:27017')
 db_name = os.environ.get('DB_NAME', 'handwritten_tables')
-client = AsyncIOMotorClient(mongo_url)
+# Bounded pool and short timeouts so a MongoDB outage fails fast instead of stalling handlers
+client = AsyncIOMotorClient(
+    mongo_url,
+    maxPoolSize=50,
+    minPoolSize=5,
+    serverSelectionTimeoutMS=3000,
+    connectTimeoutMS=3000,
+    socketTimeoutMS=10000,
+    uuidRepresentation='standard',
+)
 db = client[db_name]
 
 # Create FastAPI app
-app = FastAPI(title="Handwritten Table Converter", version="1.0.0")
+app = FastAPI(title="Handwritten Table Converter", version="1.0.0",
+              default_response_class=ORJSONResponse)
 api_router = APIRouter(prefix="/api")
 
+class UnhandledErrorMiddleware:
+    """Turn unexpected route errors into a logged 500 ProcessingResult.
+
+    Added before CORSMiddleware so it runs inside it: the 500 still gets CORS
+    headers the frontend can read, and because the error is not re-raised,
+    ServerErrorMiddleware/uvicorn don't log the traceback a second time.
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        response_started = False
+
+        async def send_wrapper(message: Message) -> None:
+            nonlocal response_started
+            if message["type"] == "http.response.start":
+                response_started = True
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        except Exception:
+            if response_started:
+                # Too late to send a 500 (e.g. a background task failed)
+                raise
+            logging.exception(f"Unhandled error on {scope['method']} {scope['path']}")
+            response = ORJSONResponse(
+                status_code=500,
+                content=ProcessingResult(success=False, message="internal error").model_dump(),
+            )
+            await response(scope, receive, send)
+
+app.add_middleware(UnhandledErrorMiddleware)
+
 # ✅ FIXED CORS Middleware (allow all during dev)
 app.add_middleware(
     CORSMiddleware,
@@ -48,6 +154,18 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+class JSONGZipMiddleware(GZipMiddleware):
+    """GZipMiddleware that leaves the XLSX download alone (it is already zipped)"""
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] == "http" and scope["path"].startswith("/api/generate-excel/"):
+            await self.app(scope, receive, send)
+            return
+        await super().__call__(scope, receive, send)
+
+# Compress JSON table payloads; small responses aren't worth the CPU
+app.add_middleware(JSONGZipMiddleware, minimum_size=1024)
+
 # -------------------------
 # Models
 # -------------------------
@@ -57,6 +175,11 @@ class TableData(BaseModel):
     extracted_data: List[List[str]]
     created_at: datetime = Field(default_factory=datetime.utcnow)
 
+class TableSummary(BaseModel):
+    id: str
+    filename: str
+    created_at: datetime
+
 class ProcessingResult(BaseModel):
     success: bool
     message: str
@@ -66,32 +189,26 @@ class ProcessingResult(BaseModel):
 # -------------------------
 # Utility Functions
 # -------------------------
-def image_to_base64(image_bytes: bytes) -> str:
-    return base64.b64encode(image_bytes).decode('utf-8')
+class BackoffLogger:
+    """Logs repeated errors at occurrence 1, 2, 4, 8, ... per key"""
 
-async def extract_table_from_image(image_bytes: bytes, filename: str) -> Dict[str, Any]:
-    try:
-        if not EMERGENT_AVAILABLE:
-            return {
-                "success": True,
-                "table_data": [
-                    ["Name", "Age", "City"],
-                    ["John", "25", "NYC"],
-                    ["Alice", "30", "LA"]
-                ],
-                "message": "Table extracted successfully (Mock data)"
-            }
-
-        image_base64 = image_to_base64(image_bytes)
-        chat = LlmChat(
-            api_key=os.environ.get('EMERGENT_LLM_KEY'),
-            session_id=f"table_extraction_{uuid.uuid4()}",
-            system_message="You are an expert at analyzing handwritten tables and extracting structured data."
-        ).with_model("openai", "gpt-4o")
+    def __init__(self):
+        self.counts = defaultdict(int)
 
-        image_content = ImageContent(image_base64=image_base64)
+    def error(self, key: str, msg: str) -> None:
+        c = self.counts[key] + 1
+        self.counts[key] = c
+        if c & (c - 1) == 0:
+            logging.error(f"[{key} x{c}] {msg}")
 
-        prompt = """Analyze this handwritten table image and extract all data into structured format.
+_err = BackoffLogger()
+
+# LLM session ids: a random prefix drawn once per process plus a counter, so ids
+# stay unique across replicas and restarts without a urandom call per request
+_SESSION_PREFIX = f"tx_{uuid.uuid4().hex[:8]}"
+_SESSION_COUNTER = itertools.count()
+
+_EXTRACTION_PROMPT = """Analyze this handwritten table image and extract all data into structured format.
 
 Return ONLY valid JSON array like:
 [
@@ -99,61 +216,136 @@ Return ONLY valid JSON array like:
   ["Row1Col1", "Row1Col2"]
 ]"""
 
-        user_message = UserMessage(text=prompt, file_contents=[image_content])
-        response = await chat.send_message(user_message)
+# Reject pathological LLM output before handing it to the JSON parser
+_MAX_AI_RESPONSE_CHARS = 256 * 1024
+
+def strip_code_fences(text: str) -> str:
+    """Remove leading ``` / ```json (any case) and trailing ``` fences around LLM output"""
+    text = text.strip()
+    if text.startswith('```'):
+        text = text[3:]
+        if text[:4].lower() == 'json':
+            text = text[4:]
+    return text.removesuffix('```').strip()
+
+_IMAGE_SIGNATURES = (
+    b'\x89PNG\r\n\x1a\n',  # PNG
+    b'\xff\xd8\xff',         # JPEG
+    b'GIF87a', b'GIF89a',     # GIF
+)
 
-        try:
-            response_text = response.strip()
-            if response_text.startswith('```'):
-                response_text = response_text.strip('`json').strip('`')
-            table_data = json.loads(response_text.strip())
-
-            if not isinstance(table_data, list) or not table_data:
-                raise ValueError("Invalid table data format")
-
-            return {
-                "success": True,
-                "table_data": table_data,
-                "message": "Table extracted successfully"
-            }
-        except json.JSONDecodeError as e:
-            logging.error(f"JSON parsing error: {e}")
-            return {"success": False, "message": "Failed to parse extracted data", "table_data": None}
+def is_image_header(header: bytes) -> bool:
+    """Check the leading bytes of an upload against known image signatures"""
+    if header.startswith(_IMAGE_SIGNATURES):
+        return True
+    if header[:4] == b'RIFF' and header[8:12] == b'WEBP':
+        return True
+    # "BM" alone is too weak; BMP headers also carry four zero reserved bytes
+    return header[:2] == b'BM' and header[6:10] == b'\0\0\0\0'
+
+# Read uploads in multiples of 3 bytes so each chunk encodes without padding
+_B64_CHUNK_SIZE = 57 * 1024
+
+async def image_to_base64_stream(upload: UploadFile) -> str:
+    encoded = bytearray()
+    pending = b""
+    while chunk := await upload.read(_B64_CHUNK_SIZE):
+        if pending:
+            chunk = pending + chunk
+        cut = len(chunk) - len(chunk) % 3
+        encoded += base64.b64encode(chunk[:cut])
+        pending = chunk[cut:]
+    encoded += base64.b64encode(pending)
+    return encoded.decode('ascii')
+
+async def extract_table_from_image(image_base64: str, filename: str) -> Dict[str, Any]:
+    if not _load_emergent():
+        return {
+            "success": True,
+            "table_data": [
+                ["Name", "Age", "City"],
+                ["John", "25", "NYC"],
+                ["Alice", "30", "LA"]
+            ],
+            "message": "Table extracted successfully (Mock data)"
+        }
+
+    if _EMERGENT_KEY_STATE is not KeyState.OK:
+        return {"success": False, "message": _KEY_STATE_MESSAGES[_EMERGENT_KEY_STATE], "table_data": None}
 
+    try:
+        chat = LlmChat(
+            api_key=_EMERGENT_KEY,
+            session_id=f"{_SESSION_PREFIX}_{next(_SESSION_COUNTER)}",
+            system_message="You are an expert at analyzing handwritten tables and extracting structured data."
+        ).with_model("openai", "gpt-4o")
+
+        image_content = ImageContent(image_base64=image_base64)
+        user_message = UserMessage(text=_EXTRACTION_PROMPT, file_contents=[image_content])
+        response = await chat.send_message(user_message)
     except Exception as e:
-        logging.error(f"OCR processing error: {e}")
-        return {"success": False, "message": f"Error: {str(e)}", "table_data": None}
+        # emergentintegrations/litellm raise their own error types (auth, rate limit,
+        # connection, rejected image), so the guard covers only the library calls
+        _err.error("llm_send", str(e))
+        return {"success": False, "message": f"AI processing failed: {str(e)}", "table_data": None}
+
+    # Cap the raw response before any scanning of it
+    if len(response) > _MAX_AI_RESPONSE_CHARS:
+        _err.error("ocr_too_large", f"{len(response)} chars")
+        return {"success": False, "message": "AI response too large", "table_data": None}
+    response_text = strip_code_fences(response)
+    if not response_text.startswith('['):
+        _err.error("ocr_not_array", "AI response is not a JSON array")
+        return {"success": False, "message": "Failed to parse extracted data", "table_data": None}
+
+    try:
+        table_data = orjson.loads(response_text)
+    except orjson.JSONDecodeError as e:
+        _err.error("ocr_parse", str(e))
+        return {"success": False, "message": "Failed to parse extracted data", "table_data": None}
+
+    if not isinstance(table_data, list) or not table_data or not isinstance(table_data[0], list):
+        _err.error("ocr_format", "AI response is not a list of rows")
+        return {"success": False, "message": "Invalid table data format", "table_data": None}
+
+    return {
+        "success": True,
+        "table_data": table_data,
+        "message": "Table extracted successfully"
+    }
 
 def create_excel_file(table_data: List[List[str]], filename: str) -> io.BytesIO:
-    workbook = Workbook()
-    worksheet = workbook.active
-    worksheet.title = "Extracted Table"
-
-    header_font = Font(bold=True, color="FFFFFF")
-    header_fill = PatternFill(start_color="366092", end_color="366092", fill_type="solid")
-    border = Border(left=Side(style='thin'), right=Side(style='thin'),
-                    top=Side(style='thin'), bottom=Side(style='thin'))
-    center_alignment = Alignment(horizontal='center', vertical='center')
-
-    for row_idx, row_data in enumerate(table_data, 1):
-        for col_idx, cell_value in enumerate(row_data, 1):
-            cell = worksheet.cell(row=row_idx, column=col_idx, value=cell_value)
-            cell.border = border
-            cell.alignment = center_alignment
-            if row_idx == 1:
-                cell.font = header_font
-                cell.fill = header_fill
-
-    for column in worksheet.columns:
-        max_length = 0
-        column_letter = column[0].column_letter
-        for cell in column:
-            try:
-                if len(str(cell.value)) > max_length:
-                    max_length = len(str(cell.value))
-            except:
-                pass
-        worksheet.column_dimensions[column_letter].width = min(max_length + 2, 50)
+    # openpyxl is only needed here, so keep it off the startup path
+    from openpyxl import Workbook
+    from openpyxl.cell import WriteOnlyCell
+    from openpyxl.utils import get_column_letter
+    _load_excel_styles()
+
+    # Write-only mode streams rows and shares style ids instead of building a cell tree
+    workbook = Workbook(write_only=True)
+    worksheet = workbook.create_sheet("Extracted Table")
+
+    # Column widths must be set before the first row is streamed
+    widths = [0] * max((len(row_data) for row_data in table_data), default=0)
+    for row_data in table_data:
+        for col_idx, cell_value in enumerate(row_data):
+            length = len(cell_value) if isinstance(cell_value, str) else len(str(cell_value))
+            if length > widths[col_idx]:
+                widths[col_idx] = length
+    for col_idx, width in enumerate(widths, 1):
+        worksheet.column_dimensions[get_column_letter(col_idx)].width = min(width + 2, 50)
+
+    for row_idx, row_data in enumerate(table_data):
+        cells = []
+        for cell_value in row_data:
+            cell = WriteOnlyCell(worksheet, value=cell_value)
+            cell.border = _BORDER
+            cell.alignment = _CENTER
+            if row_idx == 0:
+                cell.font = _HEADER_FONT
+                cell.fill = _HEADER_FILL
+            cells.append(cell)
+        worksheet.append(cells)
 
     excel_buffer = io.BytesIO()
     workbook.save(excel_buffer)
@@ -167,19 +359,36 @@ def create_excel_file(table_data: List[List[str]], filename: str) -> io.BytesIO:
 async def root():
     return {"message": "Handwritten Table Converter API", "status": "running"}
 
+async def _save_extraction(record: Dict[str, Any]) -> None:
+    try:
+        await db.table_extractions.insert_one(record)
+    except PyMongoError as e:
+        _err.error("db_insert", f"Failed to save extraction {record['id']}: {e}")
+
 @api_router.post("/upload-image", response_model=ProcessingResult)
-async def upload_image(file: UploadFile = File(...)):
-    if not file.content_type.startswith('image/'):
+async def upload_image(background: BackgroundTasks, file: UploadFile = File(...)):
+    # Content-Type is client-controlled, so sniff the magic bytes instead
+    header = await file.read(16)
+    if not is_image_header(header):
         raise HTTPException(status_code=400, detail="Only image files are allowed")
+    await file.seek(0)
 
-    image_bytes = await file.read()
-    result = await extract_table_from_image(image_bytes, file.filename)
+    image_base64 = await image_to_base64_stream(file)
+    result = await extract_table_from_image(image_base64, file.filename)
 
     if result["success"]:
-        table_record = TableData(filename=file.filename, extracted_data=result["table_data"])
-        await db.table_extractions.insert_one(table_record.dict())
+        processing_id = str(uuid.uuid4())
+        # Same shape as TableData, built directly to skip a validation + dump pass
+        record = {
+            "id": processing_id,
+            "filename": file.filename,
+            "extracted_data": result["table_data"],
+            "created_at": datetime.utcnow(),
+        }
+        # processing_id is generated here, so the write can finish after the response is sent
+        background.add_task(_save_extraction, record)
         return ProcessingResult(success=True, message=result["message"],
-                                table_data=result["table_data"], processing_id=table_record.id)
+                                table_data=result["table_data"], processing_id=processing_id)
     else:
         return ProcessingResult(success=False, message=result["message"])
 
@@ -192,16 +401,27 @@ async def generate_excel(processing_id: str):
     excel_buffer = create_excel_file(record["extracted_data"], record["filename"])
     excel_filename = f"{record['filename'].rsplit('.',1)[0]}_extracted.xlsx"
 
-    return StreamingResponse(
-        io.BytesIO(excel_buffer.read()),
+    # The workbook is already fully in memory; send it as one body instead of
+    # letting StreamingResponse iterate the BytesIO line by line
+    return Response(
+        excel_buffer.getvalue(),
         media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-        headers={"Content-Disposition": f"attachment; filename={excel_filename}"}
+        headers={"Content-Disposition": f'attachment; filename="{excel_filename}"'}
     )
 
-@api_router.get("/extractions", response_model=List[TableData])
+@api_router.get("/extractions", response_model=List[TableSummary])
 async def get_extractions():
-    records = await db.table_extractions.find().sort("created_at", -1).to_list(50)
-    return [TableData(**record) for record in records]
+    records = await db.table_extractions.find(
+        {}, {"id": 1, "filename": 1, "created_at": 1, "_id": 0}
+    ).sort("created_at", -1).to_list(50)
+    return [TableSummary(**record) for record in records]
+
+@api_router.get("/extractions/{processing_id}", response_model=TableData)
+async def get_extraction(processing_id: str):
+    record = await db.table_extractions.find_one({"id": processing_id}, {"_id": 0})
+    if not record:
+        raise HTTPException(status_code=404, detail="Processing record not found")
+    return TableData(**record)
 
 # Include router
 app.include_router(api_router)
@@ -213,7 +433,14 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(level
 async def startup_event():
     logging.info("🚀 API Started")
     logging.info(f"📊 Database: {mongo_url}/{db_name}")
-    logging.info("🧠 AI Integration: " + ("EmergentIntegrations" if EMERGENT_AVAILABLE else "Mock mode"))
+    try:
+        # Backs find_one({"id": ...}) and the created_at-sorted listing
+        await db.table_extractions.create_index("id", unique=True)
+        await db.table_extractions.create_index([("created_at", -1)])
+    except PyMongoError as e:
+        logging.warning(f"Could not ensure MongoDB indexes: {e}")
+    emergent_installed = importlib.util.find_spec("emergentintegrations") is not None
+    logging.info("🧠 AI Integration: " + ("EmergentIntegrations" if emergent_installed else "Mock mode"))
 
 @app.on_event("shutdown")
 async def shutdown_event():